@@ -2,12 +2,16 @@ import os
 import law.task
 import luigi
 import law
-import select
+import selectors
+import shlex
+import shutil
 import subprocess
 import socket
+import hashlib
 from law.util import interruptable_popen
 from rich.console import Console
 from datetime import datetime
+from functools import cached_property
 from tempfile import mkdtemp
 from getpass import getuser
 
@@ -43,6 +47,20 @@ if os.getenv("LOCAL_PWD"):
 else:
     startup_dir = os.getcwd()
 
+# Analysis name and directory set during the setup.sh, these do not change during a run
+analysis_name = os.getenv("ANA_NAME")
+analysis_path = os.getenv("ANALYSIS_PATH")
+
+# Marker for source scripts that do not change the environment of this process
+USE_PARENT_ENV = object()
+# Variables that are updated by the shell itself and do not indicate a change by a source script
+SHELL_ENV_VARS = {"_", "SHLVL", "PWD", "OLDPWD"}
+
+# Compress and decompress tarballs in parallel with pigz if available,
+#   the archives are regular gzip archives either way
+PIGZ = shutil.which("pigz")
+TAR_COMPRESSION = "--use-compress-program=pigz" if PIGZ else "--gzip"
+
 
 class Task(law.Task):
     local_user = getuser()
@@ -76,11 +94,17 @@ class Task(law.Task):
     # Set default for all inheriting Tasks
     output_collection_cls = law.NestedSiblingFileCollection
 
+    # Environments resulting from sourced scripts, shared by all tasks of the process
+    #   Keyed by the source scripts and their modification times
+    _env_cache = {}
+
     # Path of local targets.
     #   Composed from the analysis path set during the setup.sh
     #   or the local_output_path if is_local_output is set,
     #   the production_tag, the name of the task and an additional path if provided.
-    def local_path(self, *path):
+    #   The prefix is invariant over the lifetime of the task and only built once.
+    @cached_property
+    def _local_prefix(self):
         return os.path.join(
             (
                 self.local_output_path
@@ -89,9 +113,11 @@ class Task(law.Task):
             ),
             self.production_tag,
             self.__class__.__name__,
-            *path,
         )
 
+    def local_path(self, *path):
+        return os.path.join(self._local_prefix, *path)
+
     def temporary_local_path(self, *path):
         if os.environ.get("_CONDOR_JOB_IWD"):
             prefix = os.environ.get("_CONDOR_JOB_IWD") + "/tmp/"
@@ -103,7 +129,9 @@ class Task(law.Task):
 
     def local_target(self, path):
         if isinstance(path, (list, tuple)):
-            return [law.LocalFileTarget(self.local_path(p)) for p in path]
+            # Build the common prefix only once for all targets
+            base = self._local_prefix
+            return [law.LocalFileTarget(f"{base}/{p}") for p in path]
 
         return law.LocalFileTarget(self.local_path(path))
 
@@ -113,37 +141,72 @@ class Task(law.Task):
     # Path of remote targets. Composed from the production_tag,
     #   the name of the task and an additional path if provided.
     #   The wlcg_path will be prepended for WLCGFileTargets
+    @cached_property
+    def _remote_prefix(self):
+        return os.path.join(self.production_tag, self.__class__.__name__)
+
     def remote_path(self, *path):
-        parts = (self.production_tag,) + (self.__class__.__name__,) + path
-        return os.path.join(*parts)
+        return os.path.join(self._remote_prefix, *path)
+
+    # Base paths of the storage locations with environment variables expanded
+    @cached_property
+    def _wlcg_prefix(self):
+        return os.path.expandvars(self.wlcg_path)
+
+    @cached_property
+    def _local_output_prefix(self):
+        return os.path.expandvars(self.local_output_path)
+
+    # WLCG targets share law's default file system instance,
+    #   use a single local file system for the local output location as well
+    @cached_property
+    def _local_output_fs(self):
+        return law.LocalFileSystem(None, base=self._local_output_prefix)
 
     def remote_target(self, path):
         if self.is_local_output:
             return self.local_target(path)
 
         if isinstance(path, (list, tuple)):
-            return [law.wlcg.WLCGFileTarget(self.remote_path(p)) for p in path]
+            # Build the common prefix only once for all targets
+            base = self._remote_prefix
+            return [law.wlcg.WLCGFileTarget(f"{base}/{p}") for p in path]
 
         return law.wlcg.WLCGFileTarget(self.remote_path(path))
 
+    # Lines containing spaces or no "=" (e.g. exported bash functions) are skipped
     def convert_env_to_dict(self, env):
-        my_env = {}
-        for line in env.splitlines():
-            if line.find(" ") < 0:
-                try:
-                    key, value = line.split("=", 1)
-                    my_env[key] = value
-                except ValueError:
-                    pass
-        return my_env
+        return {
+            key: value
+            for key, separator, value in (
+                line.partition("=") for line in env.splitlines() if " " not in line
+            )
+            if separator
+        }
+
+    @staticmethod
+    def get_mtime(path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
 
     # Function to apply a source-script and get the resulting environment.
     #   Anything apart from setting paths is likely not included in the resulting envs.
+    #   Returns None if the scripts do not change the environment,
+    #       so that the environment of this process can be inherited by subprocesses.
     def set_environment(self, sourcescript, silent=False):
         if not silent:
             console.log(f"with source script: {sourcescript}")
         if isinstance(sourcescript, str):
             sourcescript = [sourcescript]
+        cache_key = tuple(
+            (_sourcescript, self.get_mtime(_sourcescript))
+            for _sourcescript in sourcescript
+        )
+        if cache_key in self._env_cache:
+            my_env = self._env_cache[cache_key]
+            return None if my_env is USE_PARENT_ENV else dict(my_env)
         source_command = [
             f"source {_sourcescript};" for _sourcescript in sourcescript
         ] + ["env"]
@@ -160,7 +223,22 @@ class Task(law.Task):
             console.log(f"Error: {error}")
             raise Exception("source failed")
         my_env = self.convert_env_to_dict(out)
-        return my_env
+        # check for variables that were set, changed or unset by the source scripts
+        parent_env = {
+            key: value
+            for key, value in self.convert_env_to_dict(
+                "\n".join(f"{key}={value}" for key, value in os.environ.items())
+            ).items()
+            if key not in SHELL_ENV_VARS
+        }
+        sourced_env = {
+            key: value for key, value in my_env.items() if key not in SHELL_ENV_VARS
+        }
+        if sourced_env == parent_env:
+            self._env_cache[cache_key] = USE_PARENT_ENV
+            return None
+        self._env_cache[cache_key] = my_env
+        return dict(my_env)
 
     # Run a bash command
     #   Command can be composed of multiple parts (interpreted as seperated by a space).
@@ -168,6 +246,8 @@ class Task(law.Task):
     #       env is then used for the command
     #   The command is run as if it was called from run_location
     #   With "collect_out" the output of the run command is returned
+    #   With "log_output" the output is also printed if the command succeeds,
+    #       otherwise it is only printed on failure
     def run_command(
         self,
         command=[],
@@ -175,6 +255,7 @@ class Task(law.Task):
         run_location=None,
         collect_out=False,
         silent=False,
+        log_output=False,
     ):
         if command:
             if isinstance(command, str):
@@ -198,8 +279,10 @@ class Task(law.Task):
                 env=run_env,
                 cwd=run_location,
             )
-            if not silent:
-                console.log(f"Output: {out}")
+            if (log_output and not silent) or code != 0:
+                # Print the plain text directly, without markup parsing and highlighting
+                console.log("Output:")
+                console.out(out, highlight=False)
                 console.rule()
             if not silent or code != 0:
                 console.log(f"Error: {error}")
@@ -216,14 +299,43 @@ class Task(law.Task):
         else:
             raise Exception("No command provided.")
 
+    # Log the output of pipes line by line while it arrives.
+    #   pipes maps each pipe to a format string, into which every line is inserted.
+    #   All pipes are read as data arrives, so that none of them can fill up and block the process.
+    #   The pipes are drained in large chunks instead of line by line,
+    #       keeping an incomplete line until the rest arrives.
+    def log_pipes(self, pipes):
+        selector = selectors.DefaultSelector()
+        fragments = {}
+        for pipe, format_string in pipes.items():
+            selector.register(pipe, selectors.EVENT_READ, format_string)
+            fragments[pipe] = b""
+        while selector.get_map():
+            for key, _ in selector.select():
+                chunk = os.read(key.fd, 65536)
+                if chunk:
+                    *lines, fragments[key.fileobj] = (
+                        fragments[key.fileobj] + chunk
+                    ).split(b"\n")
+                else:
+                    # EOF, flush the remaining fragment
+                    selector.unregister(key.fileobj)
+                    lines = [fragments[key.fileobj]]
+                for line in lines:
+                    line = line.decode("utf-8", errors="replace").rstrip()
+                    if line:
+                        console.log(key.data.format(line))
+        selector.close()
+
     def run_command_readable(self, command=[], sourcescript=[], run_location=None):
         """
         This can be used, to run a command, where you want to read the output while the command is running.
         redirect both stdout and stderr to the same output.
+        The command is run directly without a shell, each list element is passed as one argument.
         """
         if command:
             if isinstance(command, str):
-                command = [command]
+                command = shlex.split(command)
             if sourcescript:
                 run_env = self.set_environment(sourcescript)
             else:
@@ -235,30 +347,15 @@ class Task(law.Task):
             console.log(logstring)
             try:
                 p = subprocess.Popen(
-                    " ".join(command),
-                    shell=True,
+                    [str(part) for part in command],
                     stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
                     env=run_env,
                     cwd=run_location,
-                    encoding="utf-8",
+                    bufsize=-1,
                 )
-                while True:
-                    reads = [p.stdout.fileno(), p.stderr.fileno()]
-                    ret = select.select(reads, [], [])
-
-                    for fd in ret[0]:
-                        if fd == p.stdout.fileno():
-                            read = p.stdout.readline()
-                            if read != "\n":
-                                console.log(read.strip())
-                        if fd == p.stderr.fileno():
-                            read = p.stderr.readline()
-                            if read != "\n":
-                                console.log(read.strip())
-
-                    if p.poll() != None:
-                        break
+                self.log_pipes({p.stdout: "{}"})
+                p.wait()
                 if p.returncode != 0:
                     raise Exception(f"Error when running {command}.")
             except Exception as e:
@@ -425,6 +522,40 @@ class HTCondorWorkflow(Task, law.htcondor.HTCondorWorkflow):
         hostfile = self.bootstrap_file
         return law.util.rel_path(__file__, hostfile)
 
+    def get_tarball_signature(self, paths, base_dir=None):
+        """
+        The function `get_tarball_signature` creates a signature of the files that are packed into the
+        job tarball, based on their paths, modification times and sizes.
+
+        :param paths: The `paths` parameter is a list of files and directories to be packed into the tarball
+        :param base_dir: The `base_dir` parameter is the directory the paths are relative to
+        :return: a hex digest that changes whenever any of the files is added, removed or modified.
+        """
+        signature = hashlib.blake2b()
+        for path in paths:
+            path = os.path.join(base_dir or "", path)
+            if os.path.isdir(path):
+                files = []
+                for dirpath, dirnames, filenames in os.walk(path):
+                    # Skip the same files that are excluded from the tarball
+                    dirnames[:] = [d for d in dirnames if not d.endswith(".git")]
+                    files += [
+                        os.path.join(dirpath, filename)
+                        for filename in filenames
+                        if not filename.endswith((".pyc", ".git"))
+                    ]
+            else:
+                files = [path]
+            for filename in sorted(files):
+                try:
+                    stat = os.stat(filename)
+                    signature.update(
+                        f"{filename};{stat.st_mtime_ns};{stat.st_size}\n".encode()
+                    )
+                except OSError:
+                    signature.update(f"{filename};missing\n".encode())
+        return signature.hexdigest()
+
     def htcondor_job_config(self, config, job_num, branches):
         domain_name = str(socket.getfqdn())
 
@@ -438,7 +569,6 @@ class HTCondorWorkflow(Task, law.htcondor.HTCondorWorkflow):
             print("Unknown domain, default to CERN lxplus settings.")
             domain = "CERN"
 
-        analysis_name = os.getenv("ANA_NAME")
         task_name = self.__class__.__name__
 
         # Write job config file
@@ -485,10 +615,7 @@ class HTCondorWorkflow(Task, law.htcondor.HTCondorWorkflow):
                     "job_tarball",
                     "processor.tar.gz",
                 ),
-                fs=law.LocalFileSystem(
-                    None,
-                    base=f"{os.path.expandvars(self.local_output_path)}",
-                ),
+                fs=self._local_output_fs,
             )
         else:
             tarball = law.wlcg.WLCGFileTarget(
@@ -502,14 +629,18 @@ class HTCondorWorkflow(Task, law.htcondor.HTCondorWorkflow):
         if not tarball.exists():
             # Make new tarball
             # get absolute path to tarball dir
-            tarball_dir = os.path.abspath(f"tarballs/{self.production_tag}")
-            tarball_local = law.LocalFileTarget(
-                os.path.join(
-                    tarball_dir,
-                    task_name,
-                    "processor.tar.gz",
+            if self.is_local_output:
+                # Write the tarball directly to its final location to avoid a second copy
+                tarball_local = law.LocalFileTarget(tarball.abspath)
+            else:
+                tarball_dir = os.path.abspath(f"tarballs/{self.production_tag}")
+                tarball_local = law.LocalFileTarget(
+                    os.path.join(
+                        tarball_dir,
+                        task_name,
+                        "processor.tar.gz",
+                    )
                 )
-            )
             print(
                 f"Uploading framework tarball from {tarball_local.path} to {tarball.path}"
             )
@@ -517,40 +648,72 @@ class HTCondorWorkflow(Task, law.htcondor.HTCondorWorkflow):
             # Create tarball containing:
             #   The processor directory, thhe relevant config files, law
             #   and any other files specified in the additional_files parameter
-            command = [
-                "tar",
-                "--exclude",
-                "*.pyc",
-                "--exclude",
-                "*.git",
-                "-czf",
-                tarball_local.path,
+            tarball_content = [
                 "processor",
                 f"lawluigi_configs/{analysis_name}_luigi.cfg",
                 f"lawluigi_configs/{analysis_name}_law.cfg",
                 "law",
             ] + list(self.additional_files)
-            code, out, error = interruptable_popen(
-                command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                # rich_console=console
-            )
-            if code != 0:
-                console.log(f"Error when taring job {error}")
-                console.log(f"Output: {out}")
-                console.log(f"tar returned non-zero exit status {code}")
-                console.rule()
-                os.remove(tarball_local.path)
-                raise Exception("tar failed")
+            # Reuse an existing local tarball if none of its contents changed since it was packed
+            #   With local output, the tarball is packed directly into its final location,
+            #   which is known not to exist at this point, so there is nothing to reuse.
+            reuse_tarball = False
+            signature = None
+            if not self.is_local_output:
+                signature = self.get_tarball_signature(tarball_content, analysis_path)
+                signature_file = f"{tarball_local.path}.signature"
+                if tarball_local.exists() and os.path.exists(signature_file):
+                    with open(signature_file, "r") as f:
+                        reuse_tarball = f.read() == signature
+            if reuse_tarball:
+                console.rule("Reusing unchanged local framework tarball")
             else:
+                # Pack into a temporary file first, so that an interrupted tar
+                #   never leaves a truncated tarball at the path that is checked for reuse
+                tarball_tmp = f"{tarball_local.path}.tmp"
+                command = [
+                    "tar",
+                    "--exclude",
+                    "*.pyc",
+                    "--exclude",
+                    "*.git",
+                    TAR_COMPRESSION,
+                    "-cf",
+                    tarball_tmp,
+                ] + tarball_content
+                try:
+                    code, out, error = interruptable_popen(
+                        command,
+                        # The paths are relative to the analysis directory
+                        cwd=analysis_path,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE,
+                        # rich_console=console
+                    )
+                    if code != 0:
+                        console.log(f"Error when taring job {error}")
+                        console.log(f"Output: {out}")
+                        console.log(f"tar returned non-zero exit status {code}")
+                        console.rule()
+                        raise Exception("tar failed")
+                except BaseException:
+                    if os.path.exists(tarball_tmp):
+                        os.remove(tarball_tmp)
+                    raise
+                if signature is not None and os.path.exists(signature_file):
+                    os.remove(signature_file)
+                os.replace(tarball_tmp, tarball_local.path)
                 console.rule("Successful tar of framework tarball !")
+                if signature is not None:
+                    with open(signature_file, "w") as f:
+                        f.write(signature)
             # Copy new tarball to remote
-            tarball.parent.touch()
-            tarball.copy_from_local(src=tarball_local.path)
+            if not self.is_local_output:
+                tarball.parent.touch()
+                tarball.copy_from_local(src=tarball_local.path)
             console.rule("Framework tarball uploaded!")
         config.render_variables["USER"] = self.local_user
-        config.render_variables["ANA_NAME"] = os.getenv("ANA_NAME")
+        config.render_variables["ANA_NAME"] = analysis_name
         config.render_variables["ENV_NAME"] = self.ENV_NAME
         config.render_variables["TAG"] = self.production_tag
         config.render_variables["NTHREADS"] = self.htcondor_request_cpus
@@ -559,12 +722,10 @@ class HTCondorWorkflow(Task, law.htcondor.HTCondorWorkflow):
 
         config.render_variables["IS_LOCAL_OUTPUT"] = str(self.is_local_output)
         if not self.is_local_output:
-            config.render_variables["TARBALL_PATH"] = (
-                os.path.expandvars(self.wlcg_path) + tarball.path
-            )
+            config.render_variables["TARBALL_PATH"] = self._wlcg_prefix + tarball.path
         else:
             config.render_variables["TARBALL_PATH"] = (
-                os.path.expandvars(self.local_output_path) + tarball.path
+                self._local_output_prefix + tarball.path
             )
         config.render_variables["LOCAL_TIMESTAMP"] = startup_time
         config.render_variables["LOCAL_PWD"] = startup_dir
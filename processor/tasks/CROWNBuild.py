@@ -38,11 +38,11 @@ class CROWNBuildCombined(CROWNBuildBase):
         _compile_script = os.path.join(
             str(os.path.abspath("processor")), "tasks", "scripts", "compile_crown.sh"
         )
-        if os.path.exists(os.path.join(_install_dir, output.basename)):
+        _basename = output.basename
+        _local_output = os.path.join(os.path.abspath(_install_dir), _basename)
+        if os.path.exists(_local_output):
             console.log(f"tarball already existing in tarball directory {_install_dir}")
-            self.upload_tarball(
-                output, os.path.join(os.path.abspath(_install_dir), output.basename), 10
-            )
+            self.upload_tarball(output, _local_output, 10)
             return
         # check if certain sample types and eras are already build, if so, skip
         available_executables = []
@@ -105,15 +105,15 @@ class CROWNBuildCombined(CROWNBuildBase):
                 _shifts,  # SHIFTS=$7
                 _install_dir,  # INSTALLDIR=$8
                 _build_dir,  # BUILDDIR=$9
-                output.basename,  # TARBALLNAME=$10
+                _basename,  # TARBALLNAME=$10
                 _threads,  # THREADS=$11
             ]
             self.run_command_readable(command)
             console.rule("Finished CROWNBuild")
             # upload an small file to signal that the build is done
-        with open(os.path.join(_install_dir, output.basename), "w") as f:
+        with open(_local_output, "w") as f:
             f.write("CROWN build done")
-        output.copy_from_local(os.path.join(_install_dir, output.basename))
+        output.copy_from_local(_local_output)
 
 
 class CROWNBuild(CROWNBuildBase):
@@ -180,7 +180,7 @@ class CROWNBuild(CROWNBuildBase):
                 filter=exclude_files,
             )
         # now upload the tarball
-        self.upload_tarball(output, os.path.join(_install_dir, output.basename), 10)
+        self.upload_tarball(output, _tarball, 10)
         # delete the local tarball
         os.remove(_tarball)
         console.rule(
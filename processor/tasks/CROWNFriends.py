@@ -3,17 +3,27 @@ import luigi
 import os
 from CROWNBuildFriend import CROWNBuildFriend
 from CROWNRun import CROWNRun
+import shutil
 import tarfile
 import subprocess
-import time
+import fcntl
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
 from framework import console
 from framework import HTCondorWorkflow
+from framework import PIGZ, TAR_COMPRESSION
 from law.config import Config
 from helpers.helpers import create_abspath
 from CROWNBase import CROWNExecuteBase
 
 law.contrib.load("wlcg")
 
+# Unpack with the system tar if available, python's tarfile is used as fallback
+SYSTEM_TAR = shutil.which("tar")
+# Buffer size used when reading and extracting the tarball with tarfile
+TARFILE_BUFSIZE = 2 * 1024 * 1024
+
 
 class CROWNFriends(CROWNExecuteBase):
     """
@@ -26,14 +36,19 @@ class CROWNFriends(CROWNExecuteBase):
     nick = luigi.Parameter()
     analysis = luigi.Parameter()
 
+    # requirements are evaluated repeatedly, so only create the tarball task once
+    @cached_property
+    def _friend_tarball_req(self):
+        return CROWNBuildFriend.req(self)
+
     def workflow_requires(self):
         requirements = {}
         requirements["ntuples"] = CROWNRun.req(self)
-        requirements["friend_tarball"] = CROWNBuildFriend.req(self)
+        requirements["friend_tarball"] = self._friend_tarball_req
         return requirements
 
     def requires(self):
-        return {"friend_tarball": CROWNBuildFriend.req(self)}
+        return {"friend_tarball": self._friend_tarball_req}
 
     def create_branch_map(self):
         """
@@ -44,21 +59,22 @@ class CROWNFriends(CROWNExecuteBase):
         branch_map = {}
         counter = 0
         inputs = self.input()["ntuples"]["collection"]
-        branches = inputs._flat_target_list
+        n_scopes = len(self.scopes)
         # get all files from the dataset, including missing ones
-        for inputfile in branches:
-            if not inputfile.path.endswith(".root"):
-                continue
-            # identify the scope from the inputfile
-            scope = inputfile.path.split("/")[-2]
-            if scope in self.scopes:
+        # the outputs of each CROWNRun branch start with one ntuple per scope, in the order of
+        #   the scopes, so only these are looked at instead of all flattened targets
+        for targets in inputs.targets.values():
+            for scope, inputfile in zip(self.scopes, targets[:n_scopes]):
+                path = inputfile.path
+                if not path.endswith(".root"):
+                    continue
                 branch_map[counter] = {
                     "scope": scope,
                     "nick": self.nick,
                     "era": self.era,
                     "sample_type": self.sample_type,
-                    "inputfile": os.path.expandvars(self.wlcg_path) + inputfile.path,
-                    "filecounter": int(counter / len(self.scopes)),
+                    "inputfile": self._wlcg_prefix + path,
+                    "filecounter": counter // n_scopes,
                 }
                 counter += 1
         return branch_map
@@ -67,8 +83,11 @@ class CROWNFriends(CROWNExecuteBase):
         """
         The function `output` generates a file path based on various input parameters and returns the
         corresponding file target.
+        The targets are only created once per task, their directories are created in `run`.
         :return: The `target` variable is being returned.
         """
+        if hasattr(self, "_cached_output"):
+            return self._cached_output
         nicks = [
             "{friendname}/{era}/{nick}/{scope}/{nick}_{branch}.root".format(
                 friendname=self.friend_name,
@@ -88,10 +107,50 @@ class CROWNFriends(CROWNExecuteBase):
                     scope=self.branch_data["scope"],
                 )
             )
-        targets = self.remote_target(nicks)
-        for target in targets:
-            target.parent.touch()
-        return targets
+        self._cached_output = self.remote_target(nicks)
+        return self._cached_output
+
+    def unpack_tarball(self, tarball, workdir):
+        """
+        The function `unpack_tarball` extracts a gzipped tarball with the system tar, using pigz for the
+        decompression if it is available, and logs any messages of tar. Without a system tar, the tarball
+        is extracted in streaming mode with tarfile, using large buffers and pigz for the decompression
+        if it is available.
+
+        :param tarball: The `tarball` parameter is the path of the tarball to be extracted
+        :param workdir: The `workdir` parameter is the directory the tarball is extracted into
+        """
+        if SYSTEM_TAR is None and PIGZ:
+            with subprocess.Popen(
+                [PIGZ, "-dc", tarball],
+                stdout=subprocess.PIPE,
+                bufsize=TARFILE_BUFSIZE,
+            ) as p:
+                with tarfile.open(
+                    fileobj=p.stdout,
+                    mode="r|",
+                    bufsize=TARFILE_BUFSIZE,
+                    copybufsize=TARFILE_BUFSIZE,
+                ) as tar:
+                    tar.extractall(workdir)
+            if p.returncode != 0:
+                console.log(
+                    "pigz returned non-zero exit status {}".format(p.returncode)
+                )
+                raise Exception("pigz failed")
+            return
+        if SYSTEM_TAR is None:
+            with tarfile.open(
+                tarball, "r|gz", bufsize=TARFILE_BUFSIZE, copybufsize=TARFILE_BUFSIZE
+            ) as tar:
+                tar.extractall(workdir)
+            return
+        command = [SYSTEM_TAR, TAR_COMPRESSION, "-xf", tarball, "-C", workdir]
+        with subprocess.Popen(command, stderr=subprocess.PIPE) as p:
+            self.log_pipes({p.stderr: "tar: {}"})
+        if p.returncode != 0:
+            console.log("tar returned non-zero exit status {}".format(p.returncode))
+            raise Exception("tar failed")
 
     def run(self):
         """
@@ -110,7 +169,13 @@ class CROWNFriends(CROWNExecuteBase):
             console.log("Will create quantities map for scope {}".format(scope))
             create_quantities_map = True
             quantities_map_output = outputs[1]
-        _base_workdir = os.path.abspath("workdir")
+        # unpack and run in the node-local temporary directory if one is provided,
+        #   to avoid many small writes to a possibly shared working directory
+        _tmpdir = os.environ.get("TMPDIR")
+        if _tmpdir and os.access(_tmpdir, os.W_OK):
+            _base_workdir = os.path.join(_tmpdir, f"crownfriends_{os.getuid()}")
+        else:
+            _base_workdir = os.path.abspath("workdir")
         create_abspath(_base_workdir)
         _workdir = os.path.join(
             _base_workdir, f"{self.production_tag}_{self.friend_name}"
@@ -119,38 +184,31 @@ class CROWNFriends(CROWNExecuteBase):
         _inputfile = branch_data["inputfile"]
         # set the outputfilename to the first name in the output list, removing the scope suffix
         _outputfile = str(output.basename.replace("_{}.root".format(scope), ".root"))
-        _abs_executable = "{}/{}_{}_{}".format(
-            _workdir, self.friend_config, sample_type, era
+        _executable = "./{}_{}_{}_{}".format(
+            self.friend_config, sample_type, era, scope
         )
+        # the friend executables are built per scope, check for the one that is run
+        _abs_executable = os.path.join(_workdir, _executable)
+        _friend_tarball = self.input()["friend_tarball"]
         console.log(
-            "Getting CROWN friend_tarball from {}".format(
-                self.input()["friend_tarball"].uri()
-            )
+            "Getting CROWN friend_tarball from {}".format(_friend_tarball.uri())
         )
-        with self.input()["friend_tarball"].localize("r") as _file:
+        with _friend_tarball.localize("r") as _file:
             _tarballpath = _file.path
         # first unpack the tarball if the exec is not there yet
-        tempfile = os.path.join(
+        #   other branches on the same node block on the lock until the unpacking is done
+        lockfile = os.path.join(
             _workdir,
-            "unpacking_{}_{}_{}".format(self.friend_config, sample_type, era),
+            "unpacking_{}_{}_{}.lock".format(self.friend_config, sample_type, era),
         )
-        while os.path.exists(tempfile):
-            time.sleep(1)
-        if not os.path.exists(_abs_executable):
-            # create a temp file to signal that we are unpacking
-            open(
-                tempfile,
-                "a",
-            ).close()
-            tar = tarfile.open(_tarballpath, "r:gz")
-            tar.extractall(_workdir)
-            os.remove(tempfile)
+        with open(lockfile, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(_abs_executable):
+                self.unpack_tarball(_tarballpath, _workdir)
+            fcntl.flock(lock, fcntl.LOCK_UN)
         # set environment using env script
         my_env = self.set_environment("{}/init.sh".format(_workdir))
         _crown_args = [_outputfile] + [_inputfile]
-        _executable = "./{}_{}_{}_{}".format(
-            self.friend_config, sample_type, era, scope
-        )
         # actual payload:
         console.rule("Starting CROWNFriends")
         console.log("Executable: {}".format(_executable))
@@ -161,17 +219,11 @@ class CROWNFriends(CROWNExecuteBase):
             [_executable] + _crown_args,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            bufsize=1,
-            universal_newlines=True,
             env=my_env,
             cwd=_workdir,
         ) as p:
-            for line in p.stdout:
-                if line != "\n":
-                    console.log(line.replace("\n", ""))
-            for line in p.stderr:
-                if line != "\n":
-                    console.log("Error: {}".format(line.replace("\n", "")))
+            # read both pipes as data arrives, so that neither of them can fill up and block crown
+            self.log_pipes({p.stdout: "{}", p.stderr: "Error: {}"})
         if p.returncode != 0:
             console.log(
                 "Error when running crown {}".format(
@@ -182,43 +234,52 @@ class CROWNFriends(CROWNExecuteBase):
             raise Exception("crown failed")
         else:
             console.log("Successful")
-        console.log("Output files afterwards: {}".format(os.listdir(_workdir)))
-        output.parent.touch()
         local_filename = os.path.join(
             _workdir,
             _outputfile.replace(".root", "_{}.root".format(scope)),
         )
+        # listing the whole workdir is only done when debugging, as it contains the unpacked tarball
+        if logging.getLogger("law").isEnabledFor(logging.DEBUG):
+            console.log("Output files afterwards: {}".format(os.listdir(_workdir)))
+        else:
+            console.log("Output file: {}".format(local_filename))
+        # the outputs share their directory, so each remote directory is only created once
+        parents = {target.parent.path: target.parent for target in outputs}
+        for parent in parents.values():
+            parent.touch()
         # for each outputfile, add the scope suffix
-        output.copy_from_local(local_filename)
+        # upload in the background, while the quantities map is created from the local file
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            upload = executor.submit(output.copy_from_local, local_filename)
+            if create_quantities_map and quantities_map_output is not None:
+                console.log("Creating quantities_map.json")
+                inputfile = os.path.join(
+                    _workdir,
+                    _outputfile.replace(".root", "_{}.root".format(scope)),
+                )
+                local_outputfile = os.path.join(_workdir, "quantities_map.json")
+                console.log("inputfile: {}".format(inputfile))
+                console.log("local_outputfile: {}".format(local_outputfile))
+                console.log("outputfile: {}".format(quantities_map_output.uri()))
+                console.log("scope: {}".format(scope))
+                self.run_command(
+                    command=[
+                        "python3",
+                        "processor/tasks/helpers/GetQuantitiesMap.py",
+                        "--input {}".format(inputfile),
+                        "--era {}".format(era),
+                        "--scope {}".format(scope),
+                        "--sample_type {}".format(sample_type),
+                        "--output {}".format(local_outputfile),
+                    ],
+                    sourcescript=[
+                        "{}/init.sh".format(_workdir),
+                    ],
+                    silent=True,
+                )
+                # copy the generated quantities_map json to the output
+                quantities_map_output.copy_from_local(local_outputfile)
+                console.log("Uploaded {}".format(quantities_map_output.uri()))
+            upload.result()
         console.log("Uploaded {}".format(output.uri()))
-        if create_quantities_map and quantities_map_output is not None:
-            console.log("Creating quantities_map.json")
-            quantities_map_output.parent.touch()
-            inputfile = os.path.join(
-                _workdir,
-                _outputfile.replace(".root", "_{}.root".format(scope)),
-            )
-            local_outputfile = os.path.join(_workdir, "quantities_map.json")
-            console.log("inputfile: {}".format(inputfile))
-            console.log("local_outputfile: {}".format(local_outputfile))
-            console.log("outputfile: {}".format(quantities_map_output.uri()))
-            console.log("scope: {}".format(scope))
-            self.run_command(
-                command=[
-                    "python3",
-                    "processor/tasks/helpers/GetQuantitiesMap.py",
-                    "--input {}".format(inputfile),
-                    "--era {}".format(self.branch_data["era"]),
-                    "--scope {}".format(scope),
-                    "--sample_type {}".format(self.branch_data["sample_type"]),
-                    "--output {}".format(local_outputfile),
-                ],
-                sourcescript=[
-                    "{}/init.sh".format(_workdir),
-                ],
-                silent=True,
-            )
-            # copy the generated quantities_map json to the output
-            quantities_map_output.copy_from_local(local_outputfile)
-            console.log("Uploaded {}".format(quantities_map_output.uri()))
         console.rule("Finished CROWNFriends")
@@ -75,8 +75,7 @@ class CROWNMultiFriends(CROWNExecuteBase):
                     "nick": self.nick,
                     "era": self.era,
                     "sample_type": self.sample_type,
-                    "inputfile": os.path.expandvars(str(self.wlcg_path))
-                    + inputfile.path,
+                    "inputfile": self._wlcg_prefix + inputfile.path,
                     "filecounter": int(counter / len(self.scopes)),
                 }
                 filename = inputfile.path.split("/")[-1]
@@ -86,8 +85,7 @@ class CROWNMultiFriends(CROWNExecuteBase):
                     ):
                         break
                     branch_map[counter][f"inputfile_friend_{friend_index}"] = (
-                        os.path.expandvars(self.wlcg_path)
-                        + friend_branches[friend_index][counter].path
+                        self._wlcg_prefix + friend_branches[friend_index][counter].path
                     )
                     friend_file_name = friend_branches[friend_index][
                         counter
@@ -201,17 +199,11 @@ class CROWNMultiFriends(CROWNExecuteBase):
             [_executable] + _crown_args,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            bufsize=1,
-            universal_newlines=True,
             env=my_env,
             cwd=_workdir,
         ) as p:
-            for line in p.stdout:
-                if line != "\n":
-                    console.log(line.replace("\n", ""))
-            for line in p.stderr:
-                if line != "\n":
-                    console.log("Error: {}".format(line.replace("\n", "")))
+            # read both pipes as data arrives, so that neither of them can fill up and block crown
+            self.log_pipes({p.stdout: "{}", p.stderr: "Error: {}"})
         if p.returncode != 0:
             console.log(
                 "Error when running crown {}".format(
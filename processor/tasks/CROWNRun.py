@@ -6,6 +6,7 @@ import tarfile
 from ConfigureDatasets import ConfigureDatasets
 import subprocess
 import time
+from concurrent.futures import ThreadPoolExecutor
 from framework import console
 from law.config import Config
 from framework import Task, HTCondorWorkflow
@@ -152,6 +153,7 @@ class CROWNRun(CROWNExecuteBase):
         self.run_command(
             command=["source", "{}/init.sh".format(_workdir)],
             silent=False,
+            log_output=True,
         )
         console.rule("Finished testing Source command for CROWN")
         # set environment using env script
@@ -172,17 +174,11 @@ class CROWNRun(CROWNExecuteBase):
             command,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            bufsize=1,
-            universal_newlines=True,
             env=my_env,
             cwd=_workdir,
         ) as p:
-            for line in p.stdout:
-                if line != "\n":
-                    console.log(line.replace("\n", ""))
-            for line in p.stderr:
-                if line != "\n":
-                    console.log("Error: {}".format(line.replace("\n", "")))
+            # read both pipes as data arrives, so that neither of them can fill up and block crown
+            self.log_pipes({p.stdout: "{}", p.stderr: "Error: {}"})
         if p.returncode != 0:
             console.log(
                 "Error when running crown {}".format(
@@ -220,16 +216,20 @@ class CROWNRun(CROWNExecuteBase):
         # write the quantities_map json, per scope This is only required once per sample,
         # only do it if the branch number is 0
         if self.branch == 0:
+            commands = []
+            local_outputfiles = []
             for i, outputfile in enumerate(quantities_map_outputs):
                 outputfile.parent.touch()
                 inputfile = os.path.join(
                     _workdir,
                     _outputfile.replace(".root", "_{}.root".format(self.scopes[i])),
                 )
-                local_outputfile = os.path.join(_workdir, "quantities_map.json")
-
-                self.run_command(
-                    command=[
+                local_outputfile = os.path.join(
+                    _workdir, "quantities_map_{}.json".format(self.scopes[i])
+                )
+                local_outputfiles.append(local_outputfile)
+                commands.append(
+                    [
                         "python3",
                         "processor/tasks/helpers/GetQuantitiesMap.py",
                         "--input {}".format(inputfile),
@@ -237,12 +237,26 @@ class CROWNRun(CROWNExecuteBase):
                         "--scope {}".format(self.scopes[i]),
                         "--sample_type {}".format(self.branch_data["sample_type"]),
                         "--output {}".format(local_outputfile),
-                    ],
-                    sourcescript=[
-                        "{}/init.sh".format(_workdir),
-                    ],
-                    silent=True,
+                    ]
                 )
-                # copy the generated quantities_map json to the output
+            # the quantities maps of the scopes are independent, so create them in parallel
+            with ThreadPoolExecutor(max_workers=len(commands)) as executor:
+                futures = [
+                    executor.submit(
+                        self.run_command,
+                        command=command,
+                        sourcescript=[
+                            "{}/init.sh".format(_workdir),
+                        ],
+                        silent=True,
+                    )
+                    for command in commands
+                ]
+                for future in futures:
+                    future.result()
+            # copy the generated quantities_map jsons to the output
+            for outputfile, local_outputfile in zip(
+                quantities_map_outputs, local_outputfiles
+            ):
                 outputfile.copy_from_local(local_outputfile)
         console.rule("Finished CROWNRun")
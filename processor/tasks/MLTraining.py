@@ -147,6 +147,7 @@ class CreateTrainingDataShard(MLBase):
                 "--output-dir {}".format(out_dir),
             ],
             run_location=run_loc,
+            log_output=True,
         )
 
 
@@ -348,6 +349,7 @@ class RunTraining(MLBase):
                 "--output-dir {}".format(out_dir),
             ],
             run_location=run_loc,
+            log_output=True,
         )
 
         ## Convert model to lwtnn format
@@ -361,6 +363,7 @@ class RunTraining(MLBase):
                 "--in-out-dir {}".format(out_dir),
             ],
             run_location=run_loc,
+            log_output=True,
         )
 
         self.run_command(
@@ -592,6 +595,7 @@ class RunTesting(MLBase):
                 "--output-dir {}".format(store_dir),
             ],
             run_location=run_loc,
+            log_output=True,
         )
 
         ## Create 1D taylor coefficient plots
@@ -606,6 +610,7 @@ class RunTesting(MLBase):
                 "--output-dir {}".format(store_dir),
             ],
             run_location=run_loc,
+            log_output=True,
         )
 
         ## Create taylor ranking plots
@@ -620,6 +625,7 @@ class RunTesting(MLBase):
                 "--output-dir {}".format(store_dir),
             ],
             run_location=run_loc,
+            log_output=True,
         )
 
         ## Tar plots together
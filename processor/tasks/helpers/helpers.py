@@ -9,14 +9,10 @@ def convert_to_comma_seperated(listobject):
     :return: a comma-separated string if the input is a list, or the input itself if it is a string or a
     list with only one element.
     """
-    if isinstance(listobject, set):
-        listobject = list(listobject)
     if isinstance(listobject, str):
         return listobject
-    elif len(listobject) == 1:
-        return listobject[0]
-    else:
-        return ",".join(listobject)
+    # joining a single element does not add a comma
+    return ",".join(map(str, listobject))
 
 
 def ensure_dir(file_path):
@@ -27,7 +27,7 @@ THREADS_AVAILABLE=$(grep -c ^processor /proc/cpuinfo)
 # THREADS=$(( THREADS_AVAILABLE / 4 ))
 THREADS=2
 echo "Using ${THREADS} threads for the compilation"
-which cmake
+command -v cmake
 
 if cmake ${CROWNFOLDER} \
 	-DANALYSIS=${ANALYSIS} \
@@ -23,7 +23,7 @@ fi
 THREADS_AVAILABLE=$(grep -c ^processor /proc/cpuinfo)
 THREADS=$((THREADS_AVAILABLE / 4))
 echo "Using ${THREADS} threads for the compilation"
-which cmake
+command -v cmake
 
 if cmake ${CROWNFOLDER} \
 	-DBUILD_CROWNLIB_ONLY=ON \